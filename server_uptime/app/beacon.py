@@ -1,9 +1,13 @@
-import json
+import logging
+import time
 
 import pika
 
+from server_uptime.app.utils import PING_CONTENT_TYPE, encode_ping, url_unquote
 from server_uptime.config.settings import settings
 
+logger = logging.getLogger(__name__)
+
 
 class Beacon:
     """
@@ -25,14 +29,40 @@ class Beacon:
     def __init__(self, queue_name: str, server_name=None):
         self.rabbit_user = settings.RABBIT_USER
         self.rabbit_password = settings.RABBIT_PASSWORD
-        self.rabbit_host_ip = settings.RABBIT_HOST_IP
-        self.rabbit_port = settings.RABBIT_PORT
+        self.rabbit_host_ip = settings.RABBIT_PRODUCER_HOST_IP
+        self.rabbit_port = settings.RABBIT_PRODUCER_PORT
         self.rabbit_vhost = settings.RABBIT_VHOST
         self.connection_timeout = settings.RABBIT_CONNECTION_TIMEOUT
         self.tz = settings.TIMEZONE
 
         self.queue_name = queue_name
         self.server_name = server_name or queue_name
+        # Encoded once, the name is the same in every ping
+        self.server_name_bytes = self.server_name.upper().encode("utf-8")
+
+        # The connection parameters and message properties never change,
+        # so build them once instead of on every (re)connect or ping.
+        # pika disables Nagle's algorithm (TCP_NODELAY) on the sockets it opens,
+        # so the small ping messages are written out without coalescing delays.
+        self.connection_parameters = pika.ConnectionParameters(
+            host=self.rabbit_host_ip,
+            port=int(self.rabbit_port),
+            # Decoded like the amqp:// URL these settings were once part of
+            virtual_host=url_unquote(self.rabbit_vhost),
+            credentials=pika.PlainCredentials(
+                url_unquote(self.rabbit_user), url_unquote(self.rabbit_password)
+            ),
+            blocked_connection_timeout=float(self.connection_timeout),
+            # Name the connection so it can be told apart in the management UI
+            client_properties={"connection_name": "server-uptime-beacon"},
+        )
+        self.message_properties = pika.BasicProperties(
+            content_type=PING_CONTENT_TYPE,
+            delivery_mode=pika.spec.PERSISTENT_DELIVERY_MODE,
+        )
+        # The exchange, queue and binding are declared once per connection, and
+        # again if a publish finds the queue or its binding missing
+        self.topology_declared = False
 
         # The first thing we need to do is to establish a connection
         # with RabbitMQ server.
@@ -42,14 +72,27 @@ class Beacon:
 
     def create_connection_to_rabbitmq_host(self):
         """
-        Establishes a connection to the RabbitMQ host using the provided credentials.
+        Establishes a connection to the RabbitMQ host using the provided credentials
+        and declares the exchange and queue on it.
         """
-        self.timeout = f"blocked_connection_timeout={self.connection_timeout}"
-        rabbit_url = f"amqp://{self.rabbit_user}:{self.rabbit_password}@{self.rabbit_host_ip}:{self.rabbit_port}/{self.rabbit_vhost}?{self.timeout}"  # noqa
-
-        self.connection = pika.BlockingConnection(pika.URLParameters(rabbit_url))
+        self.connect()
+        self.declare_topology()
+
+    def connect(self):
+        """Opens a connection and a channel in confirm mode to the RabbitMQ host."""
+        self.connection = pika.BlockingConnection(self.connection_parameters)
+        # The broker may have lost the exchange or queue while we were away
+        self.topology_declared = False
+        # This channel is only ever used for publishing, never for consuming,
+        # so consumer backlogs can't stall it
         self.channel = self.connection.channel()
 
+        # Put the channel in confirm mode once, so the broker acknowledges each
+        # published ping instead of us relying on the socket flush alone.
+        self.channel.confirm_delivery()
+
+    def declare_topology(self):
+        """Declares the exchange and the queue the pings are routed to."""
         self.channel.exchange_declare(
             exchange="SERVER-UPTIME", exchange_type="direct", durable=True
         )
@@ -71,35 +114,63 @@ class Beacon:
             exchange="SERVER-UPTIME",
             routing_key=self.queue_name,
         )
+        self.topology_declared = True
 
-    def send_ping(self):
+    def wait(self, seconds: float):
+        """
+        Waits for the given number of seconds while still servicing the connection,
+        so heartbeats and other frames from the broker are not left unanswered.
+        """
+        if self.connection.is_open:
+            self.connection.sleep(seconds)
+        else:
+            time.sleep(seconds)
+
+    def send_ping(self, count: int = 1) -> bool:
         """
         Sends a ping message to the specified queue in RabbitMQ.
 
-        The message contains a count of 1 and the name of the server (optional).
+        The message contains a count and the name of the server (optional).
         The count represents the number of seconds the server has been up
         since the last ping.
         If no server name is provided, the queue_name will be used as the server name.
+
+        Returns whether the broker confirmed the ping.
         """
         if self.connection.is_closed or self.channel.is_closed:
             self.create_connection_to_rabbitmq_host()
+        elif not self.topology_declared:
+            self.declare_topology()
 
-        # This is a primitive uptime system that basically sends 1 and the server name.
+        # This is a primitive uptime system that basically sends the number of
+        # seconds since the last ping and the server name.
         # The watch_tower will then consume the count and update the uptime in the DB
-        # The 1s are basically the seconds the server has been up, if none is sent then
-        # that's how long the server is down.
+        # The counts are basically the seconds the server has been up, if none is sent
+        # then that's how long the server is down.
         # Add them up for a particular day and you get the duration to which the server
         # has been up in seconds :)
-        msg = {"count": 1, "server_name": self.server_name.upper()}
-        body = json.dumps(msg)
-
-        self.channel.basic_publish(
-            exchange="SERVER-UPTIME",
-            routing_key=self.queue_name,
-            body=body.encode("utf-8"),
-            mandatory=True,
-            properties=pika.BasicProperties(
-                delivery_mode=pika.spec.PERSISTENT_DELIVERY_MODE
-            ),
-        )
-        print(f" [x] Sent {msg}")
+        body = encode_ping(count, self.server_name_bytes)
+
+        try:
+            self.channel.basic_publish(
+                exchange="SERVER-UPTIME",
+                routing_key=self.queue_name,
+                body=body,
+                mandatory=True,
+                properties=self.message_properties,
+            )
+        except pika.exceptions.UnroutableError:
+            # The queue or its binding is gone, declare them again on the next ping
+            self.topology_declared = False
+            logger.warning(
+                "[!] Broker could not route %s from %s", count, self.server_name
+            )
+            return False
+        except pika.exceptions.NackError:
+            logger.warning(
+                "[!] Broker did not accept %s from %s", count, self.server_name
+            )
+            return False
+
+        logger.info("[x] Sent %s from %s", count, self.server_name)
+        return True
@@ -1,5 +1,6 @@
 from contextlib import contextmanager
-from datetime import datetime
+from datetime import datetime, timedelta
+from operator import itemgetter
 from typing import Dict, List, Tuple
 from urllib.parse import quote_plus
 
@@ -9,16 +10,24 @@ from sqlalchemy import (
     DateTime,
     Float,
     ForeignKey,
+    Index,
     Integer,
-    MetaData,
+    Numeric,
     String,
     Table,
+    bindparam,
+    cast,
     create_engine,
+    extract,
+    func,
+    literal,
+    literal_column,
     pool,
+    select,
 )
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm import declarative_base, relationship
 
-from server_uptime.app.utils import localize_datetime
 from server_uptime.config.settings import settings
 
 Base = declarative_base()
@@ -28,7 +37,7 @@ class Server(Base):
     __tablename__ = "server"
 
     id = Column(Integer, primary_key=True)
-    name = Column(String(30))
+    name = Column(String(30), unique=True, index=True)
     created = Column(DateTime)
     total_uptime = relationship(
         "Uptime", back_populates="server", cascade="all, delete-orphan"
@@ -37,6 +46,9 @@ class Server(Base):
 
 class Uptime(Base):
     __tablename__ = "uptime"
+    __table_args__ = (
+        Index("ix_uptime_server_date", "server_id", "record_date", unique=True),
+    )
 
     id = Column(Integer, primary_key=True)
     record_date = Column(Date)
@@ -60,6 +72,7 @@ class DBOps:
         HOST (str): The IP address or hostname of the PostgreSQL server.
         DB (str): The name of the PostgreSQL database.
         PORT (int): The port number on which the PostgreSQL server is running.
+        engine (Engine): The SQLAlchemy engine shared by every operation.
     """
 
     def __init__(self) -> None:
@@ -70,6 +83,10 @@ class DBOps:
         self.PORT = settings.DB_PORT
         self.tz = settings.TIMEZONE
 
+        # Build the engine once so its connection pool is shared across calls
+        self.engine = self.build_engine(self.get_conn_string())
+        self.build_statements()
+
         self.create_tables()  # This is idempotent
 
     def get_conn_string(self):
@@ -81,143 +98,298 @@ class DBOps:
         )
         return conn_string
 
-    def get_engine_and_metadata(
-        self, conn_string, pool_recycle=3600, poolclass=pool.QueuePool
+    def build_engine(
+        self,
+        conn_string,
+        pool_recycle=3600,
+        pool_size=10,
+        max_overflow=5,
+        poolclass=pool.QueuePool,
     ):
-        """Sets up the SQLAlchemy engine and binds metadata for the database."""
+        """Sets up the SQLAlchemy engine for the database."""
+        # pool_recycle is kept below the server/PgBouncer idle timeout and
+        # pre-ping is off to avoid an extra round-trip on every checkout.
         engine = create_engine(
-            conn_string, pool_recycle=pool_recycle, poolclass=poolclass
+            conn_string,
+            pool_recycle=pool_recycle,
+            pool_size=pool_size,
+            max_overflow=max_overflow,
+            pool_pre_ping=False,
+            poolclass=poolclass,
         )
-        metadata = MetaData(engine)
-        return engine, metadata
+        return engine
 
-    def reflect_table(self, table):
-        """Reflects a table object from the database metadata and returns it."""
-        conn_string = self.get_conn_string()
-        engine, meta = self.get_engine_and_metadata(conn_string)
-        return Table(table, meta, autoload=True, autoload_with=engine)
+    def build_statements(self):
+        """
+        Builds the statements that only differ in their parameters once, so they
+        are not reconstructed on every call and always hit SQLAlchemy's compiled
+        statement cache.
+        """
+        server_table = Server.__table__
+        uptime_table = Uptime.__table__
 
-    @contextmanager
-    def create_connection(self, stream_results=True):
+        self._stmt_select_servers = server_table.select()
+        self._stmt_select_server_by_id = server_table.select().where(
+            server_table.c.id == bindparam("id")
+        )
+        self._stmt_select_server_by_name = server_table.select().where(
+            server_table.c.name == bindparam("name")
+        )
+        self._stmt_select_servers_by_names = server_table.select().where(
+            server_table.c.name.in_(bindparam("names", expanding=True))
+        )
+        self._stmt_select_server_by_id_and_name = server_table.select().where(
+            server_table.c.id == bindparam("id"),
+            server_table.c.name == bindparam("name"),
+        )
+        self._stmt_insert_server = (
+            server_table.insert()
+            .values(name=bindparam("name"), created=bindparam("created"))
+            .returning(*server_table.c)
+        )
+        self._stmt_select_uptime = uptime_table.select().where(
+            uptime_table.c.record_date == bindparam("record_date"),
+            uptime_table.c.server_id == bindparam("server_id"),
+        )
+        # Joins the server table to compute the percentage in the same statement
+        new_uptime = bindparam("new_uptime", type_=Integer)
+        self._stmt_update_server_uptime = (
+            uptime_table.update()
+            .where(
+                uptime_table.c.server_id == server_table.c.id,
+                uptime_table.c.server_id == bindparam("server_id"),
+                uptime_table.c.record_date == bindparam("record_date"),
+            )
+            .values(
+                uptime=new_uptime,
+                last_updated=bindparam("now"),
+                uptime_percentage=self.uptime_percentage(
+                    new_uptime,
+                    server_table.c.created,
+                    bindparam("local_now", type_=DateTime),
+                    uptime_table.c.record_date,
+                ),
+            )
+        )
+
+    def get_engine_and_metadata(self):
+        """
+        Returns the shared SQLAlchemy engine and the metadata of the declarative
+        models, which is not bound to any engine.
+        """
+        return self.engine, Base.metadata
+
+    def get_table(self, table) -> Table:
         """
-        A context manager that yields a connection and bound metadata for the database.
+        Returns the table object for the given table name from the declarative
+        models, so no reflection round-trip to the database is needed.
         """
-        conn_string = self.get_conn_string()
-        engine, _ = self.get_engine_and_metadata(conn_string)
-        connection = engine.connect().execution_options(stream_results=stream_results)
         try:
-            yield connection
-        finally:
-            # close connection and send it to the connection pool
-            connection.close()
+            return Base.metadata.tables[table]
+        except KeyError:
+            raise DBOpsException(f"unknown table {table!r}")
+
+    @contextmanager
+    def create_connection(self, stream_results=False):
+        """
+        A context manager that yields a connection to the database inside a
+        transaction, which is committed on exit or rolled back on error.
+        Pass stream_results=True only for large result sets, since it makes
+        psycopg2 use a server-side cursor, which costs extra round-trips.
+        """
+        # The connection is closed and sent back to the connection pool on exit
+        with self.engine.begin() as connection:
+            yield connection.execution_options(stream_results=stream_results)
+
+    @contextmanager
+    def use_connection(self, conn=None, stream_results=False):
+        """
+        A context manager that yields the externally managed connection when one
+        is given, otherwise it checks out a new one via create_connection.
+        """
+        if conn is not None:
+            yield conn
+        else:
+            with self.create_connection(stream_results=stream_results) as connection:
+                yield connection
 
     def create_tables(self, tables: List[Table] = list()):
         """Creates tables in the database using SQLAlchemy's metadata."""
         tables = tables or None
-        conn_string = self.get_conn_string()
-        engine, _ = self.get_engine_and_metadata(conn_string)
-        return Base.metadata.create_all(engine, tables=tables)
+        Base.metadata.create_all(self.engine, tables=tables)
+
+        # create_all skips tables that already exist, so add any index that
+        # was declared after those tables were created
+        for table in tables or Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(self.engine, checkfirst=True)
 
     def drop_tables(self, tables: List[Table] = list()):
         """Drops tables from the database using SQLAlchemy's metadata."""
         tables = tables or None
-        conn_string = self.get_conn_string()
-        engine, _ = self.get_engine_and_metadata(conn_string)
-        return Base.metadata.drop_all(engine, tables=tables)
+        return Base.metadata.drop_all(self.engine, tables=tables)
 
-    def create(self, table_name: str, **kwargs):
+    def create(self, table_name: str, conn=None, **kwargs):
         """Inserts data into the specified table in the database."""
-        table = self.reflect_table(table_name)
-        with self.create_connection(stream_results=False) as conn:
+        table = self.get_table(table_name)
+        with self.use_connection(conn) as conn:
             query = table.insert().values(**kwargs)
             conn.execute(query)
 
-    def fetch_servers(self):
+    def fetch_servers(self, conn=None) -> List[Dict]:
         """
         Fetches all server records from the 'server' table
         """
-        table = self.reflect_table("server")
-        with self.create_connection() as conn:
-            query = table.select()
-            results = conn.execute(query).fetchall()
-            for result in results:
-                yield dict(result)
+        # Materialized before the connection goes back to the pool
+        with self.use_connection(conn) as conn:
+            results = conn.execute(self._stmt_select_servers).mappings().all()
+            return [dict(result) for result in results]
 
-    def get_server(self, name=None, id=None) -> Dict:
+    def get_server(self, name=None, id=None, conn=None) -> Dict:
         """
         Retrieves a server record from the 'server' table
         based on its name or ID.
         """
-        table = self.reflect_table("server")
-        with self.create_connection() as conn:
-            if id and not name:
-                query = table.select().where(table.c.id == id)
-            elif not id and name:
-                query = table.select().where(table.c.name == name)
-            elif id and name:
-                query = table.select().where(table.c.id == id, table.c.name == name)
-            else:
-                raise DBOpsException("id or server name not provided")
-
-            result = conn.execute(query).first()
+        if id and not name:
+            query = self._stmt_select_server_by_id
+        elif not id and name:
+            query = self._stmt_select_server_by_name
+        elif id and name:
+            query = self._stmt_select_server_by_id_and_name
+        else:
+            raise DBOpsException("id or server name not provided")
+
+        with self.use_connection(conn) as conn:
+            result = conn.execute(query, {"id": id, "name": name}).first()
             if result:
                 return dict(result)
             return {}
 
-    def get_uptime(self, date, server_id) -> Dict:
+    def get_uptime(self, date, server_id, conn=None) -> Dict:
         """
         Retrieves an uptime record from the 'uptime' table
         based on the date and server ID.
         """
-        table = self.reflect_table("uptime")
-        with self.create_connection() as conn:
-            query = table.select().where(
-                table.c.record_date == date, table.c.server_id == server_id
-            )
-            results = conn.execute(query).first()
+        params = {"record_date": date, "server_id": server_id}
+        with self.use_connection(conn) as conn:
+            results = conn.execute(self._stmt_select_uptime, params).first()
             if results:
                 return dict(results)
             return {}
 
-    def get_or_create_server(self, name, id=None, created=None) -> Tuple[Dict, bool]:
+    def get_or_create_server(
+        self, name, id=None, created=None, conn=None
+    ) -> Tuple[Dict, bool]:
         """
         Retrieves a server record from the 'server' table based on
         its name or id. If the record does not exist,
         it creates a new server record.
         """
-        result = self.get_server(name=name, id=id)
+        result = self.get_server(name=name, id=id, conn=conn)
         if result:
             return result, False
         else:
-            self.create("server", name=name, created=created)
-            result = self.get_server(name=name)
-            return result, True
+            params = {"name": name, "created": created}
+            with self.use_connection(conn) as conn:
+                result = conn.execute(self._stmt_insert_server, params).first()
+            return dict(result), True
 
     def update_uptime(
-        self, server: dict, date: datetime.date, uptime: int, now: datetime.now
+        self,
+        server: dict,
+        date: datetime.date,
+        uptime: int,
+        now: datetime.now,
+        conn=None,
     ):
         """
-        Updates the uptime record for a server in the 'uptime' table.
-        """
-        today_midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
-        parsed_creation_date = localize_datetime(server["created"], self.tz)
-        start_time = max(today_midnight, parsed_creation_date)
-        total_number_of_seconds_passed = (now - start_time).seconds
-        percentage = (uptime / total_number_of_seconds_passed) * 100
-        with self.create_connection(False) as conn:
-            uptime_table = self.reflect_table("uptime")
-            query = (
-                uptime_table.update()
-                .where(
-                    uptime_table.c.server_id == server["id"],
-                    uptime_table.c.record_date == date,
-                )
-                .values(
-                    uptime=uptime,
-                    last_updated=now,
-                    uptime_percentage=min(round(percentage, 2), 100),
-                )
-            )
+        Updates the uptime record for a server in the 'uptime' table,
+        computing its uptime percentage in the database.
+        """
+        params = {
+            "server_id": server["id"],
+            "record_date": date,
+            "new_uptime": uptime,
+            "now": now,
+            # created is stored without a timezone, compare it against local time
+            "local_now": now.replace(tzinfo=None),
+        }
+        with self.use_connection(conn) as conn:
+            conn.execute(self._stmt_update_server_uptime, params)
+
+    def uptime_percentage(self, uptime, created, now, record_date):
+        """
+        Returns an SQL expression computing the uptime percentage of a server
+        over its record date, from midnight or its creation time, whichever is
+        later, up to now or the end of that day, whichever is earlier.
+        All arguments are SQL expressions, now being the current local time.
+        """
+        day_start = cast(record_date, DateTime)
+        # A record from a previous day, flushed after midnight, only covers
+        # that day and not the time since today's midnight
+        end_time = func.least(now, day_start + timedelta(days=1))
+        start_time = func.greatest(day_start, created)
+        seconds_passed = func.greatest(extract("epoch", end_time - start_time), 1)
+        percentage = cast(uptime * 100.0 / seconds_passed, Numeric)
+        return func.least(func.round(percentage, 2), 100)
+
+    def upsert_servers(self, names, created=None, conn=None) -> Dict[str, Dict]:
+        """
+        Inserts a server record into the 'server' table for each of the given
+        names that does not exist yet, in a single statement, and returns the
+        record of every server keyed by its name.
+        """
+        table = Server.__table__
+        # Sorted so that concurrent upserts lock the rows in the same order
+        query = (
+            insert(table)
+            .values([{"name": name, "created": created} for name in sorted(names)])
+            .on_conflict_do_nothing(index_elements=[table.c.name])
+            .returning(table.c.id, table.c.name, table.c.created)
+        )
+        with self.use_connection(conn) as conn:
+            # RETURNING only yields the inserted rows, the existing ones are read
+            # separately rather than rewritten by a no-op DO UPDATE
+            servers = {row["name"]: dict(row) for row in conn.execute(query)}
+            existing = [name for name in names if name not in servers]
+            if existing:
+                params = {"names": existing}
+                for row in conn.execute(self._stmt_select_servers_by_names, params):
+                    servers[row["name"]] = dict(row)
+            return servers
+
+    def upsert_uptimes(self, uptimes: List[Dict], now: datetime.now, conn=None):
+        """
+        Adds the uptime of each of the given records, dicts holding a server_id,
+        record_date and uptime, to the matching record in the 'uptime' table,
+        creating the records that do not exist yet, in a single statement.
+        """
+        table = Uptime.__table__
+        rows = sorted(uptimes, key=itemgetter("server_id", "record_date"))
+        query = insert(table).values(
+            [{**row, "last_updated": now, "uptime_percentage": 100} for row in rows]
+        )
+        uptime = table.c.uptime + query.excluded.uptime
+        # created is stored without a timezone, compare it against local time
+        local_now = literal(now.replace(tzinfo=None), DateTime)
+        # Looked up per conflicting row, SQLAlchemy can't correlate a subquery
+        # against the EXCLUDED pseudo-table itself
+        created = (
+            select(Server.__table__.c.created)
+            .where(Server.__table__.c.id == literal_column("excluded.server_id"))
+            .scalar_subquery()
+        )
+        query = query.on_conflict_do_update(
+            index_elements=[table.c.server_id, table.c.record_date],
+            set_={
+                "uptime": uptime,
+                "last_updated": query.excluded.last_updated,
+                "uptime_percentage": self.uptime_percentage(
+                    uptime, created, local_now, table.c.record_date
+                ),
+            },
+        )
+        with self.use_connection(conn) as conn:
             conn.execute(query)
 
 
@@ -1,8 +1,75 @@
+import json
+import logging
+import queue
+import struct
+from functools import lru_cache
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional, Tuple
+from urllib.parse import unquote
+
 import pytz
 
+# A ping is a 4 byte big-endian count followed by the UTF-8 encoded server name
+PING_HEADER = struct.Struct("!I")
+PING_CONTENT_TYPE = "application/octet-stream"
+
+
+@lru_cache(maxsize=8)
+def get_timezone(tz):
+    """Returns the pytz timezone for the given name, looked up once per name."""
+    return pytz.timezone(tz)
+
 
 def localize_datetime(datetime_obj, tz):
     """Localizes a given datetime object to the specified timezone."""
-    local_tz = pytz.timezone(tz)
+    local_tz = get_timezone(tz)
     localized_time = local_tz.localize(datetime_obj)
     return localized_time
+
+
+def url_unquote(value: Optional[str]) -> Optional[str]:
+    """
+    Percent-decodes a setting that used to be part of an amqp:// URL, such as
+    a vhost of %2F, so it keeps meaning the same thing. None is left as is.
+    """
+    return unquote(value) if value is not None else None
+
+
+def encode_ping(count: int, server_name: bytes) -> bytes:
+    """Packs a ping count and an already encoded server name into a message body."""
+    return PING_HEADER.pack(count) + server_name
+
+
+def decode_ping(body: bytes, content_type: Optional[str] = None) -> Tuple[int, str]:
+    """
+    Unpacks a message body into the ping count and the server name, using the
+    message's content type to tell the binary format from the older JSON one.
+    """
+    if content_type != PING_CONTENT_TYPE:
+        # JSON body sent by beacons predating the binary format
+        msg = json.loads(body)
+        return int(msg["count"]), msg["server_name"]
+
+    (count,) = PING_HEADER.unpack_from(body)
+    name_offset = PING_HEADER.size
+    server_name = body[name_offset:].decode("utf-8")
+    return count, server_name
+
+
+def setup_logging(level="INFO") -> QueueListener:
+    """
+    Configures the package's loggers to hand their records to a queue, which a
+    background thread drains to stderr, so logging never blocks on the write.
+    Returns the started listener, stop it to flush the remaining records.
+    """
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+
+    logger = logging.getLogger("server_uptime")
+    logger.addHandler(QueueHandler(log_queue))
+    logger.setLevel(level)
+
+    listener = QueueListener(log_queue, handler)
+    listener.start()
+    return listener
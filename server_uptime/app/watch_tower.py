@@ -1,12 +1,15 @@
-import json
-from datetime import datetime
+import logging
+from datetime import date, datetime
+from typing import Dict, Tuple
 
 import pika
 
 from server_uptime.app.database_adapter import DBOps
-from server_uptime.app.utils import localize_datetime
+from server_uptime.app.utils import decode_ping, localize_datetime, url_unquote
 from server_uptime.config.settings import settings
 
+logger = logging.getLogger(__name__)
+
 
 class WatchTower:
     """
@@ -28,8 +31,10 @@ class WatchTower:
     Note:
         - The callback function is executed when a message is received from the RabbitMQ
             queue.
-        - The update_uptime_to_db method updates the server's uptime information in the
-            database.
+        - The callback buffers the received uptime and the flush method writes it to
+            the database, every batch_size messages or flush_interval seconds.
+        - The update_uptimes_to_db method updates the servers' uptime information in
+            the database.
         - The consume method continuously listens for messages and updates the database
             until interrupted.
         - The WatchTower class requires the DBOps class from app.database_adapter and
@@ -39,11 +44,14 @@ class WatchTower:
     def __init__(self, queue_name):
         self.rabbit_user = settings.RABBIT_USER
         self.rabbit_password = settings.RABBIT_PASSWORD
-        self.rabbit_host_ip = settings.RABBIT_HOST_IP
-        self.rabbit_port = settings.RABBIT_PORT
+        self.rabbit_host_ip = settings.RABBIT_CONSUMER_HOST_IP
+        self.rabbit_port = settings.RABBIT_CONSUMER_PORT
         self.rabbit_vhost = settings.RABBIT_VHOST
         self.connection_timeout = settings.RABBIT_CONNECTION_TIMEOUT
         self.tz = settings.TIMEZONE
+        self.prefetch_count = settings.WATCH_TOWER_PREFETCH_COUNT
+        self.batch_size = settings.WATCH_TOWER_BATCH_SIZE
+        self.flush_interval = settings.WATCH_TOWER_FLUSH_INTERVAL
 
         self.queue_name = queue_name
 
@@ -59,13 +67,36 @@ class WatchTower:
         """
         Establishes a connection to the RabbitMQ host using the provided credentials.
         """
-        self.timeout = f"blocked_connection_timeout={self.connection_timeout}"
-        rabbit_url = f"amqp://{self.rabbit_user}:{self.rabbit_password}@{self.rabbit_host_ip}:{self.rabbit_port}/{self.rabbit_vhost}?{self.timeout}"  # noqa
+        # pika disables Nagle's algorithm (TCP_NODELAY) on the sockets it opens,
+        # so the small ack frames are written out without coalescing delays.
+        parameters = pika.ConnectionParameters(
+            host=self.rabbit_host_ip,
+            port=int(self.rabbit_port),
+            # Decoded like the amqp:// URL these settings were once part of
+            virtual_host=url_unquote(self.rabbit_vhost),
+            credentials=pika.PlainCredentials(
+                url_unquote(self.rabbit_user), url_unquote(self.rabbit_password)
+            ),
+            blocked_connection_timeout=float(self.connection_timeout),
+            # Name the connection so it can be told apart in the management UI
+            client_properties={"connection_name": "server-uptime-watch-tower"},
+        )
 
         # Establish a connection with RabbitMQ server.
-        self.connection = pika.BlockingConnection(pika.URLParameters(rabbit_url))
+        self.connection = pika.BlockingConnection(parameters)
         self.channel = self.connection.channel()
 
+        # Let the broker deliver enough messages ahead to fill a whole batch
+        self.channel.basic_qos(prefetch_count=self.prefetch_count)
+
+        # Uptime received but not yet written to the database, keyed by server
+        # name and date. Since a multiple ack covers every earlier delivery, only
+        # the number of unacknowledged messages and the last delivery tag are kept.
+        # Delivery tags are scoped to a channel, so start afresh on a new one.
+        self.pending_uptimes: Dict[Tuple[str, date], int] = {}
+        self.unacked_count = 0
+        self.last_delivery_tag = None
+
         self.channel.exchange_declare(
             exchange="SERVER-UPTIME",
             exchange_type="direct",
@@ -85,39 +116,67 @@ class WatchTower:
     def callback(self, ch, method, properties, body):
         """
         The function processes received messages from the RabbitMQ queue.
-        It then updates the server uptime in the database .
+        It buffers the server uptime and flushes it to the database once
+        a whole batch has been received.
+        """
+        count, server_name = decode_ping(body, properties.content_type)
+
+        logger.debug("[x] RECEIVED %s OF UPTIME FROM %s", count, server_name)
+        key = (server_name, localize_datetime(datetime.now(), self.tz).date())
+        self.pending_uptimes[key] = self.pending_uptimes.get(key, 0) + count
+        self.unacked_count += 1
+        self.last_delivery_tag = method.delivery_tag
+
+        if self.unacked_count >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the buffered uptime to the database in a single transaction and
+        acknowledges all the messages it came from at once.
         """
-        msg = json.loads(body)
-        count = int(msg["count"])
-        server_name = msg["server_name"]
+        if not self.unacked_count:
+            return
 
-        print(f" [x] RECEIVED UPTIME FROM {server_name.upper()}")
-        self.update_uptime_to_db(count, server_name)
-        print(f" [x] DONE UPDATING {server_name.upper()} UPTIME")
+        with self.db.create_connection() as conn:
+            self.update_uptimes_to_db(self.pending_uptimes, conn=conn)
+        logger.info("[x] DONE UPDATING UPTIME FROM %s MESSAGES", self.unacked_count)
 
-        ch.basic_ack(delivery_tag=method.delivery_tag)
+        # Acknowledges every delivery up to and including the last one
+        self.channel.basic_ack(delivery_tag=self.last_delivery_tag, multiple=True)
+        self.pending_uptimes.clear()
+        self.unacked_count = 0
 
-    def update_uptime_to_db(self, count, server_name):
+    def schedule_flush(self):
         """
-        Updates the server's uptime in the database with the received count value.
+        Flushes the buffered uptime every flush_interval seconds, so that it
+        reaches the database even when a batch is slow to fill up.
+        """
+
+        def flush_and_reschedule():
+            self.flush()
+            self.schedule_flush()
+
+        self.connection.call_later(self.flush_interval, flush_and_reschedule)
+
+    def update_uptimes_to_db(self, uptimes: Dict[Tuple[str, date], int], conn=None):
+        """
+        Updates the servers' uptime in the database with the received counts,
+        keyed by server name and date.
         """
         now = localize_datetime(datetime.now(), self.tz)
-        date = now.date()
-
-        server, _ = self.db.get_or_create_server(name=server_name, created=now)
-        current_uptime = self.db.get_uptime(server_id=server["id"], date=date)
-        if current_uptime:
-            uptime = int(current_uptime["uptime"]) + int(count)
-            self.db.update_uptime(server, date, uptime, now)
-        else:
-            uptime_data = {
-                "record_date": date,
-                "last_updated": now,
+
+        names = {server_name for server_name, _ in uptimes}
+        servers = self.db.upsert_servers(names, created=now, conn=conn)
+        rows = [
+            {
+                "server_id": servers[server_name]["id"],
+                "record_date": record_date,
                 "uptime": int(count),
-                "server_id": server["id"],
-                "uptime_percentage": 100,
             }
-            self.db.create("uptime", **uptime_data)
+            for (server_name, record_date), count in uptimes.items()
+        ]
+        self.db.upsert_uptimes(rows, now, conn=conn)
 
     def consume(self):
         """
@@ -135,18 +194,18 @@ class WatchTower:
                 queue=self.queue_name, on_message_callback=self.callback
             )
 
-            print(" [*] Waiting for messages. To exit press CTRL+C")
+            logger.info("[*] Waiting for messages. To exit press CTRL+C")
 
+            self.schedule_flush()
             self.channel.start_consuming()
         except pika.exceptions.ConnectionClosedByBroker:
-            msg = """
-            CONNECTION CLOSED BY THE BROKER!!!
-
-            RE-INITIALIZING QUEUED MESSAGES CONSUMPTION
-            """
-            print(msg)
+            logger.warning(
+                "CONNECTION CLOSED BY THE BROKER!!! "
+                "RE-INITIALIZING QUEUED MESSAGES CONSUMPTION"
+            )
 
-            self.consume(self.queue_name)
+            self.consume()
         except KeyboardInterrupt:
+            self.flush()
             self.channel.close()
             self.connection.close()
@@ -18,8 +18,16 @@ from server_uptime.run import beacon, watch_tower
     default="test_uptime_queue",
     help="Name to use when setting up a queue in rabbit to hold the messages",
 )
-def start_beacon(queue_name, server_name):
-    beacon(queue_name, server_name)
+@click.option(
+    "-i",
+    "--interval",
+    "interval",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Number of seconds of uptime to accumulate before sending a ping",
+)
+def start_beacon(queue_name, server_name, interval):
+    beacon(queue_name, server_name, interval)
 
 
 @click.command()
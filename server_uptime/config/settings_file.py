@@ -14,14 +14,39 @@ RABBIT_USER = os.getenv("RABBIT_USER")
 RABBIT_PASSWORD = os.getenv("RABBIT_PASSWORD")
 RABBIT_HOST_IP = os.getenv("RABBIT_HOST_IP")
 RABBIT_PORT = os.getenv("RABBIT_PORT", 5672)
-RABBIT_VHOST = os.getenv("RABBIT_VHOST")
+RABBIT_VHOST = os.getenv("RABBIT_VHOST", "/")
+# The beacon (producer) and watch tower (consumer) should use separate
+# connections so flow control on one side doesn't throttle the other,
+# they default to the shared host and port above
+RABBIT_PRODUCER_HOST_IP = os.getenv("RABBIT_PRODUCER_HOST_IP", RABBIT_HOST_IP)
+RABBIT_PRODUCER_PORT = os.getenv("RABBIT_PRODUCER_PORT", RABBIT_PORT)
+RABBIT_CONSUMER_HOST_IP = os.getenv("RABBIT_CONSUMER_HOST_IP", RABBIT_HOST_IP)
+RABBIT_CONSUMER_PORT = os.getenv("RABBIT_CONSUMER_PORT", RABBIT_PORT)
 RABBIT_CONNECTION_TIMEOUT = os.getenv(
     "RABBIT_CONNECTION_TIMEOUT", 60 * 60 * 6
 )  # six hours
 
+# Watch Tower Config
+# Messages the broker may deliver ahead before they are acknowledged
+WATCH_TOWER_PREFETCH_COUNT = int(os.getenv("WATCH_TOWER_PREFETCH_COUNT", 200))
+# Messages buffered before their uptime is written to the database
+WATCH_TOWER_BATCH_SIZE = int(os.getenv("WATCH_TOWER_BATCH_SIZE", 100))
+# Seconds after which buffered uptime is written even if the batch isn't full
+WATCH_TOWER_FLUSH_INTERVAL = float(os.getenv("WATCH_TOWER_FLUSH_INTERVAL", 1))
+
+# Beacon Config
+# Number of seconds of uptime accumulated locally before a ping is sent,
+# at least one like the CLI's --interval, falling back to the default otherwise
+ping_interval = int(os.getenv("BEACON_PING_INTERVAL", 10))
+BEACON_PING_INTERVAL = ping_interval if ping_interval >= 1 else 10
+
+# Logging Config
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+
+ALL_TIMEZONES = frozenset(pytz.all_timezones)
+
 
 def tz_is_valid(tz):
-    ALL_TIMEZONES = set(pytz.all_timezones)
     return tz in ALL_TIMEZONES
 
 
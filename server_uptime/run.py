@@ -1,20 +1,62 @@
+import logging
 import time
 
+import pika
+
 from server_uptime.app.beacon import Beacon
+from server_uptime.app.utils import setup_logging
 from server_uptime.app.watch_tower import WatchTower
+from server_uptime.config.settings import settings
+
+logger = logging.getLogger(__name__)
+
+
+def beacon(queue_name: str, server_name=None, interval=None):
+    log_listener = setup_logging(settings.LOG_LEVEL)
+    try:
+        run_beacon(queue_name, server_name, interval)
+    finally:
+        log_listener.stop()
 
 
-def beacon(queue_name: str, server_name=None):
+def run_beacon(queue_name: str, server_name=None, interval=None):
+    interval = interval or settings.BEACON_PING_INTERVAL
     beacon = Beacon(queue_name, server_name)
+    # Uptime that has not been confirmed by the broker yet, it is carried over
+    # to the next ping so that broker outages don't lose any uptime
+    unsent = 0
+    # Pings are paced against a monotonic deadline rather than sleeping a fixed
+    # interval after each one, so the time spent sending doesn't add up as drift
+    next_tick = time.monotonic() + interval
     while True:
         try:
-            # Send ping every 1 second
-            beacon.send_ping()
-            time.sleep(1)
+            # Accumulate `interval` seconds of uptime, then send them in one ping
+            beacon.wait(max(0, next_tick - time.monotonic()))
+            # Count every deadline that has passed, more than one only when a
+            # previous ping or reconnect overran the interval
+            ticks = int((time.monotonic() - next_tick) // interval) + 1
+            if ticks < 1:
+                continue
+            next_tick += ticks * interval
+            unsent += ticks * interval
+            if beacon.send_ping(count=unsent):
+                unsent = 0
+        except (
+            pika.exceptions.AMQPConnectionError,
+            pika.exceptions.AMQPChannelError,
+        ) as error:
+            # The connection and channel are re-established on the next ping
+            logger.warning("[!] Lost connection to RabbitMQ: %r", error)
         except KeyboardInterrupt:
-            beacon.connection.close()
+            if beacon.connection.is_open:
+                beacon.connection.close()
+            break
 
 
 def watch_tower(queue_name: str):
-    watch_tower = WatchTower(queue_name)
-    watch_tower.consume()
+    log_listener = setup_logging(settings.LOG_LEVEL)
+    try:
+        watch_tower = WatchTower(queue_name)
+        watch_tower.consume()
+    finally:
+        log_listener.stop()